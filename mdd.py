@@ -3,86 +3,319 @@
 # SPDX-FileCopyrightText: 2024 Roman Gilg <romangg@manjaro.org>
 # SPDX-License-Identifier: MIT
 import os
+import sys
 import uuid
-import psutil
 import hashlib
 import platform
 import subprocess
 import json
-import requests
-import pytz
+import gzip
+import urllib.request
 import shutil
+import socket
+import threading
+import time
 import logging
 import argparse
-import tzlocal
 import re
-import distro
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from dateutil import parser as date_parser
 
+# The heavier third-party modules (psutil, pytz, tzlocal, distro, dateutil)
+# are imported lazily inside the functions that need them, keeping them off
+# the startup path of short runs.
+
+try:
+    import orjson
+except ImportError:
+    # Fall back to the stdlib json module
+    orjson = None
+
+
+# Static system identity, looked up once instead of per call site since
+# platform issues a uname call every time.
+MACHINE = platform.machine()
+KERNEL_RELEASE = platform.release()
+
+METRICS_HOST = "metrics-api.manjaro.org"
+METRICS_URL = f"https://{METRICS_HOST}/send"
 
 inxi = None
 
+# Cheap one-line shell probes that used to fork a shell each. They are batched
+# into a single shell invocation by collect_shell_bundle() before the
+# collectors run and consumed from this dict afterwards.
+shell_bundle = {}
+
+BUNDLE_SENTINEL = "\0MDD\0"
+
+BUNDLE_PROBES = {
+    "install_ts": "stat -c %W /",
+    "chassis": "hostnamectl chassis",
+    "locale": "localectl status | grep 'System Locale'",
+    "branch": "pacman-mirrors -G",
+}
+
+
+def collect_shell_bundle():
+    global shell_bundle
+
+    # printf renders the escaped form into the actual NUL sentinel
+    script = "; printf '\\0MDD\\0'; ".join(
+        cmd + " 2>/dev/null" for cmd in BUNDLE_PROBES.values()
+    )
+
+    try:
+        result = subprocess.run(
+            ["bash", "-c", script], capture_output=True, text=True, timeout=30
+        )
+        shell_bundle = {
+            key: part.strip() for key, part in zip(BUNDLE_PROBES, result.stdout.split(BUNDLE_SENTINEL))
+        }
+    except Exception as e:
+        logging.error(f"collecting shell bundle: {str(e)}")
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dump_bytes(data):
+    return orjson.dumps(data) if orjson else json.dumps(data).encode()
+
 
 def json_beaut(input, sort_keys=False):
+    if orjson:
+        option = orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(input, option=option).decode()
     return json.dumps(input, indent=4, sort_keys=sort_keys)
 
 
+which_cache = {}
+
+
+def which(name):
+    """Cached shutil.which, so repeated probes do not re-walk PATH."""
+    if name not in which_cache:
+        which_cache[name] = shutil.which(name)
+    return which_cache[name]
+
+
+def warm_up_connection():
+    """Resolves the metrics host early so the DNS lookup overlaps with data collection."""
+    try:
+        socket.getaddrinfo(METRICS_HOST, 443)
+    except OSError as e:
+        logging.info(f"warming up connection: {str(e)}")
+
+
+inxi_proc = None
+
+
 def prepare_inxi():
-    global inxi
+    """Starts inxi in the background; collect_inxi() waits for the result."""
+    global inxi_proc
 
-    if not shutil.which("inxi"):
+    if not which("inxi"):
         logging.warning(f"Did not find inxi. Data collection is limited.")
         return
 
     try:
-        result = subprocess.run(
+        inxi_proc = subprocess.Popen(
             ["inxi", "-Fxxx", "--output", "json", "--output-file", "print"],
-            capture_output=True,
-            text=True,
-            timeout=30,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
-        inxi = json.loads(result.stdout.strip())
     except Exception as e:
         logging.error(f"calling inxi: {str(e)}")
 
 
+def collect_inxi():
+    global inxi, inxi_proc
+
+    if not inxi_proc:
+        return
+
+    try:
+        stdout, _ = inxi_proc.communicate(timeout=30)
+
+        # Both orjson and the stdlib parser accept the raw bytes, so the
+        # payload does not have to be decoded into an intermediate string.
+        raw = json_loads(stdout)
+
+        # Index the main categories and their items by the stripped key
+        # suffix once, so every lookup afterwards is a plain dict access
+        # instead of a scan over all keys.
+        inxi = {}
+        for item in raw:
+            for key, val in item.items():
+                if isinstance(val, list):
+                    val = [
+                        (
+                            {k.rsplit("#", 1)[-1]: v for k, v in entry.items()}
+                            if isinstance(entry, dict)
+                            else entry
+                        )
+                        for entry in val
+                    ]
+                inxi[key.rsplit("#", 1)[-1]] = val
+    except subprocess.TimeoutExpired as e:
+        # Kill and reap the child like subprocess.run does on timeout,
+        # otherwise inxi keeps running after we drop the reference
+        inxi_proc.kill()
+        inxi_proc.communicate()
+        logging.error(f"calling inxi: {str(e)}")
+    except Exception as e:
+        logging.error(f"calling inxi: {str(e)}")
+    finally:
+        inxi_proc = None
+
+
 def get_inxi_val(parent, code):
-    for key in parent.keys():
-        if key.endswith(code):
-            return parent[key]
-    return None
+    return parent.get(code.lstrip("#"))
 
 
 def get_inxi_main_cat(code):
-    for item in inxi:
-        for key in item.keys():
-            if key.endswith(code):
-                return item[key]
-    return None
+    return inxi.get(code.lstrip("#"))
 
 
-def get_command_output(cmd, default=None):
+def get_command_output(cmd, default=None, **run_kwargs):
+    """Runs a command and returns its stripped output.
+
+    Pass an argv list to execute the binary directly. Strings are run through
+    the shell for the few callers that need pipelines or quoting. Additional
+    keyword arguments are passed on to subprocess.run.
+    """
     try:
-        result = subprocess.run(cmd, capture_output=True, check=True, shell=True)
+        result = subprocess.run(
+            cmd, capture_output=True, check=True, shell=isinstance(cmd, str), **run_kwargs
+        )
         return result.stdout.decode("utf-8").strip()
     except subprocess.CalledProcessError as e:
-        logging.info(
-            f"Command '{cmd}' failed with: '{e.returncode}: {e.stderr.decode("utf-8")}'"
-        )
+        stderr = e.stderr.decode("utf-8")
+        logging.info(f"Command '{cmd}' failed with: '{e.returncode}: {stderr}'")
+        return default
+    except OSError as e:
+        # Without the shell a missing binary surfaces here instead of as a
+        # 127 exit status
+        logging.info(f"Command '{cmd}' failed with: '{str(e)}'")
+        return default
+
+
+def read_file(path, default=None):
+    """Reads a small procfs/sysfs file directly instead of shelling out to cat."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError as e:
+        logging.info(f"reading '{path}': {str(e)}")
         return default
 
 
+def find_last_in_file(path, needle, chunk_size=64 * 1024):
+    """Returns the last line containing needle, reading the file backward.
+
+    Only the tail of the file is read in the common case, instead of piping
+    the whole file through grep and tail.
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            buffer = b""
+
+            while pos > 0:
+                read_size = min(chunk_size, pos)
+                pos -= read_size
+                f.seek(pos)
+                buffer = f.read(read_size) + buffer
+
+                idx = buffer.rfind(needle)
+                if idx < 0:
+                    # A match may still straddle the chunk boundary. Keeping
+                    # everything up to the first newline preserves both the
+                    # overlap and the tail of a line matched later.
+                    newline = buffer.find(b"\n")
+                    if newline >= 0:
+                        buffer = buffer[: newline + 1]
+                    continue
+
+                start = buffer.rfind(b"\n", 0, idx)
+                if start < 0 and pos > 0:
+                    # The line begins in an earlier chunk, read on
+                    continue
+
+                end = buffer.find(b"\n", idx)
+                if end < 0:
+                    end = len(buffer)
+                return buffer[start + 1 : end].decode("utf-8", errors="replace")
+    except OSError as e:
+        logging.info(f"searching '{path}': {str(e)}")
+
+    return None
+
+
+state_cache = None
+
+STATE_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "mdd",
+    "state.json",
+)
+
+
+def get_cached_state(key, compute):
+    """Returns a boot-invariant value from the on-disk cache, computing it on miss.
+
+    The cache is dropped when the machine id or the kernel release changes.
+    Compute functions signal failure with None, which is never cached.
+    """
+    global state_cache
+
+    try:
+        stamp = f"{int(os.stat('/etc/machine-id').st_mtime)}:{KERNEL_RELEASE}"
+    except OSError:
+        stamp = KERNEL_RELEASE
+
+    if state_cache is None:
+        try:
+            with open(STATE_CACHE_PATH, "rb") as f:
+                state_cache = json_loads(f.read())
+        except (OSError, ValueError):
+            state_cache = {}
+
+        if state_cache.get("stamp") != stamp:
+            state_cache = {"stamp": stamp}
+
+    if key in state_cache:
+        return state_cache[key]
+
+    value = compute()
+    if value is None:
+        return None
+
+    state_cache[key] = value
+    try:
+        os.makedirs(os.path.dirname(STATE_CACHE_PATH), exist_ok=True)
+        with open(STATE_CACHE_PATH, "w") as f:
+            f.write(json.dumps(state_cache))
+    except OSError as e:
+        logging.info(f"writing state cache: {str(e)}")
+
+    return value
+
+
 def get_hashed_device_id():
     # Read the machine ID
     with open("/etc/machine-id", "r") as f:
         machine_id = f.read().strip()
 
-    # Hash the machine ID using SHA-256 to anonymize it
-    hashed_id = hashlib.sha256(machine_id.encode()).digest()
+    # Hash the machine ID using BLAKE2b to anonymize it. The digest is sized
+    # to the 16 bytes the UUID needs, so nothing is computed just to be cut off
+    hashed_id = hashlib.blake2b(machine_id.encode(), digest_size=16).digest()
 
-    # Convert the first 16 bytes of the hash to a UUID (version 5 UUID format)
-    return str(uuid.UUID(bytes=hashed_id[:16], version=5))
+    # Convert the hash to a UUID (version 5 UUID format)
+    return str(uuid.UUID(bytes=hashed_id, version=5))
 
 
 def dualboot_os_prober_check():
@@ -92,13 +325,29 @@ def dualboot_os_prober_check():
     """
     logging.info("...check for Windows with os-prober")
 
-    if not shutil.which("os-prober"):
+    if not which("os-prober"):
         raise Exception("os-prober is not installed")
 
+    if os.geteuid() != 0:
+        # Without root, os-prober only works through passwordless sudo. Probe
+        # that cheaply first instead of letting os-prober scan and fail.
+        try:
+            sudo_works = (
+                subprocess.run(
+                    ["sudo", "-n", "true"], capture_output=True, timeout=1
+                ).returncode
+                == 0
+            )
+        except Exception:
+            sudo_works = False
+
+        if not sudo_works:
+            raise Exception("not root and passwordless sudo is unavailable")
+
     try:
         # Try direct execution first (if running as root)
         result = subprocess.run(
-            ["os-prober"], capture_output=True, text=True, timeout=30
+            ["os-prober"], capture_output=True, text=True, timeout=5
         )
 
         if result.returncode != 0:
@@ -116,7 +365,7 @@ def dualboot_os_prober_check():
         ):
             # Permission error detected, try sudo if available without password
             result = subprocess.run(
-                ["sudo", "-n", "os-prober"], capture_output=True, text=True, timeout=30
+                ["sudo", "-n", "os-prober"], capture_output=True, text=True, timeout=5
             )
 
         if result.returncode != 0:
@@ -139,23 +388,31 @@ def dualboot_os_prober_check():
         raise OSError(f"os-prober failed: {str(e)}")
 
 
+lsblk_data = None
+
+
+def get_lsblk_data():
+    """Runs lsblk once and caches the parsed tree for all disk consumers."""
+    global lsblk_data
+    if lsblk_data is None:
+        lsblk_data = json_loads(
+            get_command_output(["lsblk", "-Jbo", "NAME,TYPE,SIZE,FSTYPE,MOUNTPOINTS"])
+        )
+    return lsblk_data
+
+
 def dualboot_lsblk_check(min_size_gb=20):
     """
-    Get all partitions using lsblk command, including unmounted ones
+    Check all partitions for Windows characteristics, including unmounted ones
     """
     logging.info("...check for Windows dualboot with lsblk")
 
     min_size_bytes = min_size_gb * 1024 * 1024 * 1024
 
-    cmd = ["lsblk", "-b", "-J", "-o", "NAME,SIZE,FSTYPE,MOUNTPOINT"]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-
-    if result.returncode != 0:
-        raise OSError(f"Error running lsblk: code {result.returncode}")
-
-    data = json.loads(result.stdout)
+    stack = list(get_lsblk_data().get("blockdevices", []))
+    while stack:
+        device = stack.pop()
 
-    def process_device(device):
         # Check the device itself
         if (
             str(device.get("fstype", "")).lower() == "ntfs"
@@ -167,14 +424,7 @@ def dualboot_lsblk_check(min_size_gb=20):
             return True
 
         # Check children (partitions)
-        for child in device.get("children", []):
-            if process_device(child):
-                return True
-
-    # Process all devices
-    for device in data.get("blockdevices", []):
-        if process_device(device):
-            return True
+        stack.extend(device.get("children", []))
 
     logging.info(
         "No partition found with Windows characteristics. Assuming single-boot system."
@@ -198,60 +448,95 @@ def check_windows_dualboot():
             return False
 
 
+# Process names to look for in get_compositor, mapped to the reported name.
+COMPOSITORS = {
+    "sway": "sway",
+    "compiz": "compiz",
+    "mutter": "mutter",
+    "kwin": "kwin",
+    "kwin_x11": "kwin",
+    "kwin_wayland": "kwin",
+    "xfwm4": "xfwm4",
+    "picom": "picom",
+    "compton": "compton",
+}
+
+
+compositor_cache = None
+
+
 def get_compositor():
-    """Returns the compositor currently in use on a Linux system."""
-    compositors = ["sway", "compiz", "mutter", "kwin", "xfwm4", "picom", "compton"]
+    """Returns the compositor currently in use on a Linux system.
+
+    The graphics and desktop collectors both ask; the process scan only
+    happens for the first call.
+    """
+    global compositor_cache
+
+    if compositor_cache is not None:
+        return compositor_cache
+
+    result = "unknown"
     try:
-        output = subprocess.check_output("ps -e", shell=True, text=True)
-        for compositor in compositors:
-            if compositor in output:
-                return compositor
+        for entry in os.scandir("/proc"):
+            if not entry.name.isdigit():
+                continue
+
+            try:
+                with open(f"/proc/{entry.name}/comm") as f:
+                    comm = f.read().strip()
+            except OSError:
+                # The process exited in the meantime
+                continue
+
+            if compositor := COMPOSITORS.get(comm):
+                result = compositor
+                break
 
     except Exception as e:
         logging.error("getting compositor:", e)
         pass
 
-    return "unknown"
+    # Publish the cache only after the scan is done. Concurrent callers may
+    # scan twice, but can never observe a half-finished placeholder value.
+    compositor_cache = result
+    return result
 
 
-def get_install_date():
-    """Returns the installation date of the Linux system as a timestamp."""
-    date = "unknown"
-    try:
-        # Using `stat` to get the creation time of the root directory
-        timestamp = int(
-            subprocess.check_output("stat -c %W /", shell=True, text=True).strip()
-        )
+def compute_install_date():
+    import pytz
 
-        date = datetime.fromtimestamp(timestamp, pytz.UTC).isoformat()
+    try:
+        # Creation time of the root directory, gathered with `stat` in the shell bundle
+        timestamp = int(shell_bundle.get("install_ts", ""))
+        return datetime.fromtimestamp(timestamp, pytz.UTC).isoformat()
 
     except Exception as e:
         logging.error(f"retrieving installation date: {e}")
-        pass
+        return None
+
 
-    return date
+def get_install_date():
+    """Returns the installation date of the Linux system as a timestamp."""
+    return get_cached_state("install_date", compute_install_date) or "unknown"
 
 
 def get_system_info():
     logging.info("...get system info")
 
     common_data = {
-        "kernel": platform.release(),
-        "form_factor": get_command_output("hostnamectl chassis"),
+        "kernel": KERNEL_RELEASE,
+        "form_factor": shell_bundle.get("chassis") or None,
         "install_date": get_install_date(),
     }
 
     def get_dmi(file_name: str):
-        return get_command_output("cat /sys/devices/virtual/dmi/id/" + file_name)
+        return read_file("/sys/devices/virtual/dmi/id/" + file_name)
 
-    if platform.machine() == "aarch64":
-        product_name = get_command_output("cat /proc/device-tree/model").replace(
-            chr(0), ""
-        )
+    if MACHINE == "aarch64":
+        product_name = read_file("/proc/device-tree/model", "").replace(chr(0), "")
         device_compat = (
-            get_command_output("cat /proc/device-tree/compatible")
-            .replace(chr(0), " ")
-            .split(",")
+            read_file("/proc/device-tree/compatible", "").replace(chr(0), " ").split(",")
         )
 
         def get_compat(pos):
@@ -274,14 +559,18 @@ def get_system_info():
 
 def get_boot_info():
     logging.info("...get boot info")
+    import psutil
+
     return {
         "uefi": os.path.isdir("/sys/firmware/efi"),
-        "uptime_seconds": int(float(get_command_output("cat /proc/uptime").split()[0])),
+        "uptime_seconds": int(time.time() - psutil.boot_time()),
     }
 
 
 def get_cpu_info():
     logging.info("...get cpu info")
+    import psutil
+
     cpu_model = ""
     cpu_model2 = ""
 
@@ -304,23 +593,24 @@ def get_cpu_info():
         cpu_model += cpu_model2
 
     if not cpu_model:
-        # Fallback to lscpu in case we did not get info from inxi
+        # Fallback to /proc/cpuinfo in case we did not get info from inxi.
+        # Heterogeneous systems can report more than one distinct model name.
         try:
-            lines = [
-                line
-                for line in get_command_output("lscpu").split("\n")
-                if "Model name" in line
-            ]
+            models = []
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("model name"):
+                        model = line.split(":", 1)[1].strip()
+                        if model not in models:
+                            models.append(model)
 
-            cpu_model = lines[0].split(":")[1].strip()
-            if len(lines) > 1:
-                cpu_model += "/" + lines[1].split(":")[1].strip()
+            cpu_model = "/".join(models)
 
-        except IndexError as e:
-            pass
+        except OSError as e:
+            logging.error(f"reading cpuinfo: {str(e)}")
 
     info = {
-        "arch": platform.machine(),
+        "arch": MACHINE,
         "model": cpu_model,
         "cores": psutil.cpu_count(logical=False),
         "threads": psutil.cpu_count(logical=True),
@@ -331,12 +621,29 @@ def get_cpu_info():
 
 def get_memory_info():
     logging.info("...get memory info")
+
+    totals = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith(("MemTotal:", "SwapTotal:")):
+                    totals[line.split(":")[0]] = int(line.split()[1]) * 1024
+                    if len(totals) == 2:
+                        break
+    except OSError as e:
+        logging.error(f"reading meminfo: {str(e)}")
+
     return {
-        "ram_gb": psutil.virtual_memory().total / (1024**3),
-        "swap_gb": psutil.swap_memory().total / (1024**3),
+        "ram_gb": totals.get("MemTotal", 0) / (1024**3),
+        "swap_gb": totals.get("SwapTotal", 0) / (1024**3),
     }
 
 
+# Precompiled patterns for the per-line xrandr parsing in get_graphics_info.
+XRANDR_OUTPUT_RE = re.compile(r"^(\S+) (dis)?connected")
+XRANDR_MODE_RE = re.compile(r"^ {3}(\d+x\d+).*\s([\d.]+)\*")
+
+
 def get_graphics_info():
     logging.info("...get graphics info")
 
@@ -380,40 +687,48 @@ def get_graphics_info():
     compositor = compositor if compositor else get_compositor()
 
     if len(gpus) == 0:
-        glxinfo = (
-            get_command_output("glxinfo | grep 'OpenGL vendor'")
-            if shutil.which("glxinfo")
-            else None
+        glxinfo = get_command_output(["glxinfo"], "") if which("glxinfo") else ""
+        gl_vendor = next(
+            (line for line in glxinfo.splitlines() if "OpenGL vendor" in line), None
         )
+        vga_models = [
+            line.split(":", 2)[-1].strip()
+            for line in get_command_output(["lspci"], "").splitlines()
+            if "vga" in line.lower()
+        ]
         gpu_info = {
             "vendor": "",
-            "model": get_command_output("lspci | grep -i vga | cut -d ':' -f3"),
-            "driver": (glxinfo.split(": ")[-1] if glxinfo else None),
+            "model": "\n".join(vga_models),
+            "driver": (gl_vendor.split(": ")[-1] if gl_vendor else None),
         }
         gpus.append(gpu_info)
 
     # Run xrandr command and capture output
-    if xrandr_output := shutil.which("xrandr") and get_command_output("xrandr"):
+    if xrandr_output := which("xrandr") and get_command_output(["xrandr"]):
         mapped = None
         inxi_output = None
 
         for line in xrandr_output.split("\n"):
-            if re.match(r"^(\S+) disconnected", line):
-                mapped = None
-                continue
-
-            if re.match(r"^(\S+) connected", line):
-                # When we encounter a line that contains the word 'connected', we mark the beginning
-                # of a new connected output and continue with the line afterwards.
-                mapped = line.split(" ")
-                inxi_output = next(
-                    (output for output in outputs if output["mapped"] == mapped[0]),
-                    None,
-                )
+            if not line.startswith(" "):
+                # Only unindented lines can describe an output's state, only
+                # indented ones a mode - never apply both patterns to a line.
+                if output_match := XRANDR_OUTPUT_RE.match(line):
+                    if output_match.group(2):
+                        # Disconnected output
+                        mapped = None
+                        continue
+
+                    # When we encounter a line that contains the word 'connected', we mark the beginning
+                    # of a new connected output and continue with the line afterwards.
+                    mapped = line.split(" ")
+                    inxi_output = next(
+                        (output for output in outputs if output["mapped"] == mapped[0]),
+                        None,
+                    )
 
                 continue
 
-            mode_match = re.match(r"^ {3}(\d+x\d+).*\s([\d.]+)\*", line)
+            mode_match = XRANDR_MODE_RE.match(line)
             if not mode_match:
                 # Inactive mode
                 continue
@@ -469,29 +784,64 @@ def get_graphics_info():
     }
 
 
+installed_pkgs = None
+
+
+def get_installed_pkgs():
+    """Returns the names of all installed packages from a single pacman -Qq dump."""
+    global installed_pkgs
+    if installed_pkgs is None:
+        installed_pkgs = set(get_command_output(["pacman", "-Qq"], "").split())
+    return installed_pkgs
+
+
+def is_installed(pkg):
+    return pkg in get_installed_pkgs()
+
+
+def get_session_uid():
+    """Returns the uid of the desktop session user when running as root."""
+    if sudo_uid := os.environ.get("SUDO_UID"):
+        return int(sudo_uid)
+    if pkexec_uid := os.environ.get("PKEXEC_UID"):
+        return int(pkexec_uid)
+
+    # Fall back to the user runtime dirs, preferring one with an audio socket
+    try:
+        uids = [
+            int(entry.name)
+            for entry in os.scandir("/run/user")
+            if entry.name.isdigit() and int(entry.name) >= 1000
+        ]
+    except OSError as e:
+        logging.info(f"scanning /run/user: {str(e)}")
+        return None
+
+    for uid in uids:
+        for socket_name in ("pipewire-0", "pulse"):
+            if os.path.exists(f"/run/user/{uid}/{socket_name}"):
+                return uid
+
+    return uids[0] if uids else None
+
+
 def get_audio_info():
     logging.info("...get audio info")
 
     info = {"servers": []}
 
-    def is_installed(pkg):
-        try:
-            result = subprocess.run(
-                ["pacman", "-Qi", pkg], capture_output=True, text=True
-            )
-            return result.returncode == 0
-        except Exception as e:
-            logging.error("checking install:", e)
-            return False
-
     pulseaudio_active = False
     found_pipewire = False
 
-    sudo = ["", ""]
-    if os.geteuid() == 0:
-        user = get_command_output("last -wn1").split("\n")[0].split(" ")[0]
-        user_id = get_command_output("su - " + user + " -c 'id -u'")
-        sudo = ["su - " + user + " -c 'XDG_RUNTIME_DIR=/run/user/" + user_id + " ", "'"]
+    # The audio servers answer per session. As root, query them as the session
+    # user directly instead of the old last/su subprocess chain.
+    run_args = {"env": os.environ | {"LANG": "C"}}
+    if os.geteuid() == 0 and (uid := get_session_uid()) is not None:
+        run_args = {
+            "user": uid,
+            "env": os.environ
+            | {"LANG": "C", "XDG_RUNTIME_DIR": f"/run/user/{uid}"},
+        }
 
     if is_installed("pulseaudio"):
         pulse_info = {
@@ -500,9 +850,7 @@ def get_audio_info():
         }
 
         # pactl is a dependency of pulseaudio
-        pulse_out = get_command_output(sudo[0] + "LANG=C pactl info" + sudo[1]).split(
-            "\n"
-        )
+        pulse_out = get_command_output(["pactl", "info"], "", **run_args).split("\n")
         for line in pulse_out:
             if line.startswith("Server Name"):
                 name = line.split(" ", 2)[-1].lower()
@@ -527,7 +875,7 @@ def get_audio_info():
     if not found_pipewire and is_installed("pipewire"):
         # Check if PipeWire is active (PulseAudio might not be installed)
         pipew_active = False
-        if pipew_out := get_command_output(sudo[0] + "LANG=C pw-cli info 0" + sudo[1]):
+        if pipew_out := get_command_output(["pw-cli", "info", "0"], **run_args):
             pipew_active = 'core.daemon = "true"' in pipew_out
         info["servers"].append(
             {
@@ -541,53 +889,48 @@ def get_audio_info():
 def get_disks_metrics():
     """Returns metrics about the disks and partitions containing the root and /home mounts."""
 
-    def traverse(block, results, min_size, is_crypt):
-        is_crypt = (
-            is_crypt
-            or block.get("type") == "crypt"
-            or block.get("fstype") == "crypto_LUKS"
-        )
-        min_size = min(min_size, block.get("size"))
-
-        def get_mount_data():
-            return {
-                "size_gb": min_size / (1024**3),
-                "fstype": block.get("fstype"),
-                "crypt": is_crypt,
-            }
-
-        if block.get("mountpoints"):
-            # Check for root or home partition mountpoints
-            has_root = False
-
-            if "/" in block["mountpoints"]:
-                results["root"] = get_mount_data()
-                has_root = True
-
-            if "/home" in block["mountpoints"]:
-                data = get_mount_data()
-                if has_root:
-                    data["subvol"] = True
-                results["home"] = data
-
-        # If it's a disk with children, traverse each child
-        if "children" in block:
-            for child in block["children"]:
-                traverse(child, results, min_size, is_crypt)
-
     disks = []
-    lsblk_data = json.loads(
-        get_command_output("lsblk -Jbo NAME,TYPE,SIZE,FSTYPE,MOUNTPOINTS")
-    )
 
-    for device in lsblk_data["blockdevices"]:
+    for device in get_lsblk_data()["blockdevices"]:
         size = device.get("size")
         results = {
             "size_gb": size / (1024**3),
             "root": None,
             "home": None,
         }
-        traverse(device, results, size, False)
+
+        # Walk the device tree with an explicit stack, carrying the smallest
+        # enclosing size and the crypt flag down to each child.
+        stack = [(device, size, False)]
+        while stack:
+            block, min_size, is_crypt = stack.pop()
+            is_crypt = (
+                is_crypt
+                or block.get("type") == "crypt"
+                or block.get("fstype") == "crypto_LUKS"
+            )
+            min_size = min(min_size, block.get("size"))
+
+            if block.get("mountpoints"):
+                # Check for root or home partition mountpoints
+                mount_data = {
+                    "size_gb": min_size / (1024**3),
+                    "fstype": block.get("fstype"),
+                    "crypt": is_crypt,
+                }
+                has_root = False
+
+                if "/" in block["mountpoints"]:
+                    results["root"] = mount_data
+                    has_root = True
+
+                if "/home" in block["mountpoints"]:
+                    if has_root:
+                        mount_data = mount_data | {"subvol": True}
+                    results["home"] = mount_data
+
+            for child in block.get("children", []):
+                stack.append((child, min_size, is_crypt))
 
         if results["root"] or results["home"]:
             disks.append(results)
@@ -605,6 +948,7 @@ def get_disk_info():
 
 def get_locale_info():
     logging.info("...get locale info")
+    import tzlocal
 
     try:
         timezone = str(tzlocal.get_localzone())
@@ -613,10 +957,8 @@ def get_locale_info():
         timezone = "error"
 
     return {
-        "region": get_command_output(
-            "localectl status | grep 'System Locale'", ""
-        ).split("=")[-1],
-        "language": get_command_output("echo $LANG", "").split("_")[0],
+        "region": shell_bundle.get("locale", "").split("=")[-1],
+        "language": os.environ.get("LANG", "").split("_")[0],
         "timezone": timezone,
     }
 
@@ -624,12 +966,16 @@ def get_locale_info():
 def get_pacman_mirrors_info():
     logging.info("...get pacman-mirrors info")
 
-    if not shutil.which("pacman-mirrors"):
+    if not which("pacman-mirrors"):
         return {"total": None, "ok": None, "country_config": ""}
 
     try:
-        country_config = get_command_output("pacman-mirrors --country-config")
-        output = get_command_output("pacman-mirrors --status")
+        country_config = subprocess.run(
+            ["pacman-mirrors", "--country-config"],
+            capture_output=True,
+            text=True,
+            timeout=30,
+        ).stdout.strip()
 
         # Initialize counters for total and OK mirrors
         total_mirrors = 0
@@ -658,13 +1004,26 @@ def get_pacman_mirrors_info():
         return {"total": None, "ok": None, "country_config": ""}
 
 
+def count_lines(output):
+    """Counts the lines of stripped command output without building a list."""
+    return output.count("\n") + 1 if output else 0
+
+
+def count_installed_packages():
+    """Counts installed packages from the local pacman DB, one dir per package."""
+    try:
+        return sum(1 for entry in os.scandir("/var/lib/pacman/local") if entry.is_dir())
+    except OSError as e:
+        logging.info(f"reading local pacman db: {str(e)}")
+        return len(get_installed_pkgs())
+
+
 def get_package_info():
     logging.info("...get package info")
+    from dateutil import parser as date_parser
 
     try:
-        output = get_command_output(
-            'grep -a "\\[ALPM\\] upgraded" /var/log/pacman.log | tail -1'
-        )
+        output = find_last_in_file("/var/log/pacman.log", b"[ALPM] upgraded")
         update_time = date_parser.parse(output.split(" ")[0].strip("[]")).isoformat()
     except Exception as e:
         logging.error(f"getting update time: '{str(e)}'")
@@ -672,15 +1031,15 @@ def get_package_info():
         update_time = "unknown"
 
     flatpaks = 0
-    if shutil.which("flatpak"):
-        flatpaks = int(get_command_output("flatpak list --app | wc -l", "0"))
+    if which("flatpak"):
+        flatpaks = count_lines(get_command_output(["flatpak", "list", "--app"], ""))
 
     return {
         "last_update": update_time,
-        "branch": get_command_output("pacman-mirrors -G", "unknown"),
-        "pkgs": int(get_command_output("pacman -Q | wc -l")),
-        "foreign_pkgs": int(get_command_output("pacman -Qm | wc -l")),
-        "pkgs_update_pending": int(get_command_output("pacman -Qu | wc -l")),
+        "branch": shell_bundle.get("branch") or "unknown",
+        "pkgs": count_installed_packages(),
+        "foreign_pkgs": count_lines(get_command_output(["pacman", "-Qm"], "")),
+        "pkgs_update_pending": count_lines(get_command_output(["pacman", "-Qu"], "")),
         "flatpaks": flatpaks,
         "pacman_mirrors": get_pacman_mirrors_info(),
     }
@@ -730,11 +1089,14 @@ def get_desktop_info():
 
 
 def get_device_data(telemetry: bool):
+    import distro
+    import pytz
+
     data = {
         "meta": {
             "version": 1,
             "timestamp": datetime.now(pytz.UTC).isoformat(),
-            "device_id": get_hashed_device_id(),
+            "device_id": get_cached_state("device_id", get_hashed_device_id),
             "distro_id": distro.id(),
         }
     }
@@ -742,24 +1104,42 @@ def get_device_data(telemetry: bool):
     if not telemetry:
         return data
 
+    collect_shell_bundle()
+
+    # Resolve all binaries the collectors probe for in one batch, so the
+    # PATH walks happen once up front instead of scattered across the pool.
+    for name in ("glxinfo", "os-prober", "xrandr", "flatpak", "pacman-mirrors"):
+        which(name)
+
+    # inxi has been scanning in the background since main started; the
+    # collectors read its data, so wait for it before the pool runs.
+    collect_inxi()
+
     data["meta"] |= {
         "release": distro.version(),
         "inxi": inxi is not None,
     }
 
-    data |= {
-        "system": get_system_info(),
-        "boot": get_boot_info(),
-        "cpu": get_cpu_info(),
-        "memory": get_memory_info(),
-        "graphics": get_graphics_info(),
-        "audio": get_audio_info(),
-        "disk": get_disk_info(),
-        "locale": get_locale_info(),
-        "package": get_package_info(),
-        "desktop": get_desktop_info(),
+    collectors = {
+        "system": get_system_info,
+        "boot": get_boot_info,
+        "cpu": get_cpu_info,
+        "memory": get_memory_info,
+        "graphics": get_graphics_info,
+        "audio": get_audio_info,
+        "disk": get_disk_info,
+        "locale": get_locale_info,
+        "package": get_package_info,
+        "desktop": get_desktop_info,
     }
 
+    # The collectors spend most of their time waiting on subprocesses, so run
+    # them concurrently. The inxi data is prepared before the pool starts and
+    # only read afterwards, making it safe to share without locking.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {name: executor.submit(func) for name, func in collectors.items()}
+        data |= {name: future.result() for name, future in futures.items()}
+
     return data
 
 
@@ -800,13 +1180,21 @@ def main():
         datefmt="%Y-%m-%dT%H:%M:%S",
     )
 
+    # Launch inxi right away; it scans in the background while the rest of
+    # the preparation work runs and is awaited in get_device_data.
+    if not args.telemetry:
+        # The ping-only payload carries no system data, inxi would be wasted
+        logging.info("Skipping inxi because telemetry is disabled.")
+    elif os.getenv("MDD_DISABLE_INXI"):
+        logging.info("Skipping inxi because MDD_DISABLE_INXI was set.")
+    else:
+        prepare_inxi()
+
     print(f"{BOLD}{HEADER}Welcome to MDD - The Manjaro Data Donor{ENDC}")
     print(f"{OKBLUE}Preparing data submission...{ENDC}")
 
-    if os.getenv("MDD_DISABLE_INXI"):
-        logging.info(f"Skipping inxi because MDD_DISABLE_INXI was set.")
-    else:
-        prepare_inxi()
+    if not args.dry_run:
+        threading.Thread(target=warm_up_connection, daemon=True).start()
 
     data = get_device_data(args.telemetry)
 
@@ -827,17 +1215,22 @@ def main():
         return
 
     try:
-        response = requests.post(
-            "https://metrics-api.manjaro.org/send",
-            json=data,
-            headers={"Content-Type": "application/json"},
-            timeout=2,
+        # Compressing the JSON payload shrinks it several-fold; urlopen
+        # raises on HTTP error status by itself.
+        request = urllib.request.Request(
+            METRICS_URL,
+            data=gzip.compress(json_dump_bytes(data)),
+            headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            },
         )
 
-        response.raise_for_status()
+        with urllib.request.urlopen(request, timeout=2):
+            pass
     except Exception as e:
         logging.error(f"submitting telemetry: {e}")
-        exit(1)
+        sys.exit(1)
 
     print("Succesful sent at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 